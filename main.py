@@ -1,12 +1,16 @@
 import base64
 import datetime
+import functools
 import io
 import os
 import requests
-import json
-import ndjson
+import orjson
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
+from urllib3.util.retry import Retry
 from google.cloud import bigquery, secretmanager, pubsub_v1
 from google.api_core.exceptions import ClientError, Conflict
 from google.cloud.exceptions import NotFound
@@ -19,24 +23,170 @@ TOTALREQUESTS = 0
 LEAD_DOCKET_BASE_URL = os.environ.get('LEAD_DOCKET_BASE_URL')
 if not (LEAD_DOCKET_BASE_URL):
     exit("Required environment variables not set. Please set the LEAD_DOCKET_BASE_URL variable.")
+# The base URL for requests for a single lead, which only needs the lead id appended
+LEADS_BY_ID_URL = urljoin(LEAD_DOCKET_BASE_URL, "leads/")
 # The number of leads to process in one batch
 BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '100'))
+# The maximum number of concurrent requests to send to LeadDocket
+LEADDOCKET_CONCURRENCY = int(os.environ.get('LEADDOCKET_CONCURRENCY', '16'))
+# A shared session so that requests to LeadDocket reuse keep-alive connections. Connection errors
+# and server errors are retried with a backoff. Rate limits are throttled ahead of time by
+# RATE_LIMIT_CREDITS in get_from_lead_docket, and handle_api_errors is the fallback for any 429
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=LEADDOCKET_CONCURRENCY,
+    pool_maxsize=LEADDOCKET_CONCURRENCY,
+    max_retries=Retry(total=3, backoff_factor=2, status_forcelist=[500, 502, 503, 504], raise_on_status=False)))
 # The project for the pubsub topic
 PUBSUB_PROJECT_ID = os.environ.get('PUBSUB_PROJECT_ID')
 # The pubsub topic
 PUBSUB_TOPIC_ID = os.environ.get('PUBSUB_TOPIC_ID')
+# Whether the dataset and prod table are known to exist. Module globals persist across warm
+# invocations of the Cloud Function, so the existence checks only run once per instance
+DATASET_EXISTS = False
+PROD_TABLE_EXISTS = False
+
+class CreditBucket:
+    """ Tracks the LeadDocket rate limit credits shared by all request threads
+
+    LeadDocket reports the number of requests left in the current rate limit window with the
+    X-RateLimit-Remaining header, and the time that the window resets with X-RateLimit-Reset.
+    Every request takes a credit before it is sent. Once the credits run out, threads wait for
+    the window to reset instead of sending requests that are going to fail with a 429.
+    """
+
+    def __init__(self):
+        # The credits are unknown until a response with rate limit headers is received
+        self.credits = None
+        self.reset_time = None
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """ Takes a single credit, waiting for the rate limit window to reset if none are left
+
+        The global request count is also incremented here, since the condition's lock is
+        already held and requests are sent from several threads at once.
+
+        :return none
+        """
+        global TOTALREQUESTS
+        with self.cond:
+            while self.credits is not None and self.credits <= 0:
+                sleep_time = self.reset_time - time.time()
+                if sleep_time <= 0:
+                    # The window has reset, so send requests until a response reports the new credits
+                    self.credits = None
+                    break
+                # Pad the wait with one second, matching the padding used by handle_api_errors
+                self.cond.wait(sleep_time + 1)
+
+            if self.credits is not None:
+                self.credits -= 1
+            TOTALREQUESTS += 1
+
+    def update(self, response_headers):
+        """ Updates the credits from the rate limit headers of a LeadDocket response
+
+        :param response_headers: (dict) the headers of a response from LeadDocket
+        :return none
+        """
+        remaining = response_headers.get('X-RateLimit-Remaining')
+        reset_time = response_headers.get('X-RateLimit-Reset')
+        if remaining is None or reset_time is None:
+            return
+
+        with self.cond:
+            if self.credits is None or float(reset_time) != self.reset_time:
+                # A new rate limit window has started
+                self.credits = int(remaining)
+            else:
+                # Requests that are still in flight have already taken their credits
+                self.credits = min(self.credits, int(remaining))
+            self.reset_time = float(reset_time)
+            self.cond.notify_all()
+
+# The rate limit credits shared by every request to LeadDocket
+RATE_LIMIT_CREDITS = CreditBucket()
+
+@functools.lru_cache(maxsize=None)
+def get_bigquery_client():
+    """ Get a BigQuery client
+
+    Creating a client looks up credentials and opens new connections, so a single client is
+    created and reused for the lifetime of the process (including warm Cloud Function invocations).
+
+    :return: (bigquery.Client) the shared BigQuery client
+    """
+    return bigquery.Client()
 
-def convert_to_newline_delimeted_json(jsonData):
-    """ Converts JSOn to Newline Delimited JSON
+@functools.lru_cache(maxsize=None)
+def get_secret_manager_client():
+    """ Get a Secret Manager client
 
-    This helper function converts JSON into newline delimeted JSON. This is useful
-    because BigQuery can run into issues when using normal JSON:
-    https://cloud.google.com/bigquery/docs/loading-data-cloud-storage-json
+    A single client is created and reused for the lifetime of the process, the same as
+    get_bigquery_client.
 
-    :param jsonData (dict) the jsonData to convert
-    :return (json) the converted json
+    :return: (secretmanager.SecretManagerServiceClient) the shared Secret Manager client
     """
-    return ndjson.dumps(jsonData)
+    return secretmanager.SecretManagerServiceClient()
+
+class NDJSONReader(io.RawIOBase):
+    """ A read-only file of leads in Newline Delimited JSON
+
+    BigQuery can run into issues when using normal JSON, so leads are loaded as newline
+    delimeted JSON: https://cloud.google.com/bigquery/docs/loading-data-cloud-storage-json
+
+    Each lead is serialized when the upload reads it, so the NDJSON for the whole set of
+    leads is never built up in memory before the upload starts.
+    """
+
+    def __init__(self, leads):
+        """
+        :param leads: (iterable) the leads to serialize, each as a python dict
+        """
+        self._leads = iter(leads)
+        self._buffer = b""
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        # The upload checks the position of the file before it starts and after every chunk
+        return self._position
+
+    def read(self, size=-1):
+        """ Reads up to size bytes of NDJSON, or all remaining bytes when size is negative or None
+
+        A short read means that the file has ended, so leads are serialized until the
+        requested size is filled.
+
+        :param size: (int) the maximum number of bytes to read
+        :return (bytes) the NDJSON that was read
+        """
+        chunks = []
+        remaining = -1 if size is None else size
+        while remaining != 0:
+            if not self._buffer:
+                lead = next(self._leads, None)
+                if lead is None:
+                    break
+                self._buffer = orjson.dumps(lead) + b"\n"
+
+            chunk = self._buffer if remaining < 0 else self._buffer[:remaining]
+            self._buffer = self._buffer[len(chunk):]
+            chunks.append(chunk)
+            if remaining > 0:
+                remaining -= len(chunk)
+
+        data = b"".join(chunks)
+        self._position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
 
 def save_data_to_json(fileName, jsonData):
     """ Saves the output of a run to a JSON file
@@ -48,8 +198,23 @@ def save_data_to_json(fileName, jsonData):
     :param jsonData (dict) the jsonData to print to a JSON file
     :return none
     """
-    f = open(fileName, "w")
-    f.write(json.dumps(jsonData))
+    with open(fileName, "wb") as f:
+        f.write(orjson.dumps(jsonData))
+
+def get_from_lead_docket(url, headers):
+    """ Sends a GET request to LeadDocket
+
+    A helper function that waits for a rate limit credit, sends the request through the shared
+    session, and then updates the rate limit credits from the headers of the response.
+
+    :param url: (str) the url to request
+    :param headers: (dict) the headers for an API request, including the API key
+    :return response (requests.Response) the response from LeadDocket
+    """
+    RATE_LIMIT_CREDITS.acquire()
+    response = SESSION.get(url, headers=headers)
+    RATE_LIMIT_CREDITS.update(response.headers)
+    return response
 
 def handle_api_errors(response, url, headers):
     """ Handles LeadDocket API Errors
@@ -62,7 +227,6 @@ def handle_api_errors(response, url, headers):
     :param headers (dict) the headers to use if the request needs to be retried
     :return response (dict) the retried response
     """
-    global TOTALREQUESTS
     retries = 0
     max_retries = 5 # TODO move to global env
     while (response.status_code != 200 and retries <= max_retries):
@@ -86,8 +250,7 @@ def handle_api_errors(response, url, headers):
             time.sleep(60)
 
         print(f"Retry #{retries} of max {max_retries}")
-        response = requests.get(url, headers=headers)
-        TOTALREQUESTS +=1
+        response = get_from_lead_docket(url, headers)
     print(f"X-RateLimit-Remaining: {response.headers.get('X-RateLimit-Remaining')}; " 
         f"X-RateLimit-Reset: {response.headers.get('X-RateLimit-Reset')}; "
         f"X-RateLimit-Limit: {response.headers.get('X-RateLimit-Limit')}")
@@ -100,12 +263,13 @@ def convert_datetime_to_date(datetime_string):
     LeadDocket API returns a datetime for client_birthday as a datetime, but exports
     the same field in UI reports as a date.
 
+    The API always returns datetimes in the form YYYY-MM-DDTHH:MM:SS, so the date is the first
+    ten characters of the string.
+
     :param datetime_string: (string) a datetime in the form of a string
-    :return (string) a string formatted as a date
+    :return (string) a string formatted as a date (YYYY-MM-DD)
     """
-    format = "%Y-%m-%dT%H:%M:%S"
-    dt_object = datetime.datetime.strptime(datetime_string, format)
-    return f"{dt_object.year}-{dt_object.month}-{dt_object.day}"
+    return datetime_string[:10]
 
 def get_lead_changes_since(minutes, headers):
     """ Gets LeadDocket leads that have experienced a status changes since a specified time
@@ -130,13 +294,10 @@ def get_lead_changes_since(minutes, headers):
     # Look for changes since time_to_query
     last_status_changes_since_endpoint = f"leads/laststatuschangesince?date={time_to_query}"
     url = urljoin(LEAD_DOCKET_BASE_URL, last_status_changes_since_endpoint)
-    response = requests.get(url, headers=headers)
-
-    global TOTALREQUESTS
-    TOTALREQUESTS += 1
+    response = get_from_lead_docket(url, headers)
 
     print(f"Initial LeadDocket API request returned with status code: {response.status_code}")
-    changed_records_json = response.json()
+    changed_records_json = orjson.loads(response.content)
 
     # Output and store information about the total number of leads found
     global LEADCOUNT
@@ -145,149 +306,147 @@ def get_lead_changes_since(minutes, headers):
 
     # Extract the records from the API response
     records_to_update = []
+    records_to_update.extend(changed_records_json['Records'])
 
-    def _extractRecords(json_to_extract):
-        for record in json_to_extract['Records']:
-            records_to_update.append(record)
-
-    _extractRecords(changed_records_json)
-
-    if changed_records_json['TotalPages'] > 1:
-        print("Additional pages of leads found, grabbing more data...")
-
-        # Start the loop on page two since we already gathered page one with our initial request
-        page_iter = 2
+    def _get_page(page_iter):
+        page_url = f"{url}&page={page_iter}"
+        print(f"Getting records on page: {page_iter}")
 
-        # Send a new API request for each new page of data
-        while page_iter <= changed_records_json['TotalPages']:
-            page_endpoint = f"{last_status_changes_since_endpoint}&page={page_iter}"
-            page_url = urljoin(LEAD_DOCKET_BASE_URL, page_endpoint)
-            print(f"Getting records on page: {page_iter}")
-
-            # Pass the response to an error handler to deal with rate limits and unexpected errors.
-            # The error handler will retry a single failed request
-            response = handle_api_errors(requests.get(page_url, headers=headers), url, headers)
-            TOTALREQUESTS += 1
+        # Pass the response to an error handler to deal with rate limits and unexpected errors.
+        # The error handler will retry a single failed request
+        response = handle_api_errors(get_from_lead_docket(page_url, headers), page_url, headers)
 
-            if(response.status_code != 200):
-                # If the second API request fails, the rate limit may have a backoff period, or our key may be blocked,
-                # and we should give up
-                print(f"API requests have continued to fail on page {page_iter}")
-                exit("API requests failing after waiting. Exiting Early.")
+        if(response.status_code != 200):
+            # If the second API request fails, the rate limit may have a backoff period, or our key may be blocked,
+            # and we should give up
+            print(f"API requests have continued to fail on page {page_iter}")
+            exit("API requests failing after waiting. Exiting Early.")
 
-            leads_json = response.json()
+        return orjson.loads(response.content)
 
-            # Extract the records from the API data
-            _extractRecords(leads_json)
+    if changed_records_json['TotalPages'] > 1:
+        print("Additional pages of leads found, grabbing more data...")
 
-            page_iter += 1
+        # The first page tells us how many pages there are, so the rest of the pages can be requested
+        # at the same time. Start on page two since we already gathered page one with our initial request
+        with ThreadPoolExecutor(max_workers=LEADDOCKET_CONCURRENCY) as executor:
+            for leads_json in executor.map(_get_page, range(2, changed_records_json['TotalPages'] + 1)):
+                # Extract the records from the API data
+                records_to_update.extend(leads_json['Records'])
 
     return records_to_update
 
 
-def upload_to_bigquery(leads, table_id, write_mode):
+# The schema of the staging and production tables
+LEAD_SCHEMA = [
+    bigquery.SchemaField("id", "INTEGER"),
+    bigquery.SchemaField("status", "STRING"),
+    bigquery.SchemaField("substatus", "STRING"),
+    bigquery.SchemaField("severitylevel", "INTEGER"),
+    bigquery.SchemaField("code", "STRING"),
+    bigquery.SchemaField("contact_firstname", "STRING"),
+    bigquery.SchemaField("contact_middlename", "STRING"),
+    bigquery.SchemaField("contact_lastname", "STRING"),
+    bigquery.SchemaField("contact_address1", "STRING"),
+    bigquery.SchemaField("contact_address2", "STRING"),
+    bigquery.SchemaField("contact_city", "STRING"),
+    bigquery.SchemaField("contact_state", "STRING"),
+    bigquery.SchemaField("contact_zip", "STRING"),
+    bigquery.SchemaField("contact_county", "STRING"),
+    bigquery.SchemaField("contact_homephone", "STRING"),
+    bigquery.SchemaField("contact_mobilephone", "STRING"),
+    bigquery.SchemaField("contact_workphone", "STRING"),
+    bigquery.SchemaField("contact_email", "STRING"),
+    bigquery.SchemaField("contact_preferredcontactmethod", "STRING"),
+    bigquery.SchemaField("contact_birthdate", "DATE"),
+    bigquery.SchemaField("contact_subscribetomailinglist", "BOOL"),
+    bigquery.SchemaField("contact_badaddress", "BOOL"),
+    bigquery.SchemaField("contact_deceased", "BOOL"),
+    bigquery.SchemaField("contact_gender", "STRING"),
+    bigquery.SchemaField("contact_minor", "BOOL"),
+    bigquery.SchemaField("contact_language", "STRING"),
+    bigquery.SchemaField("practicearea_name", "STRING"),
+    bigquery.SchemaField("practicearea_code", "STRING"),
+    bigquery.SchemaField("marketingsource", "STRING"),
+    bigquery.SchemaField("contactsource", "STRING"),
+    bigquery.SchemaField("talkedtootherattorneys", "BOOL"),
+    bigquery.SchemaField("utm", "STRING"),
+    bigquery.SchemaField("currenturl", "STRING"),
+    bigquery.SchemaField("referringurl", "STRING"),
+    bigquery.SchemaField("clickid", "STRING"),
+    bigquery.SchemaField("clientid", "STRING"),
+    bigquery.SchemaField("keywords", "STRING"),
+    bigquery.SchemaField("campaign", "STRING"),
+    bigquery.SchemaField("appointmentlocation", "STRING"),
+    bigquery.SchemaField("office", "STRING"),
+    bigquery.SchemaField("referredto_name", "STRING"),
+    bigquery.SchemaField("referredbyname", "STRING"),
+    bigquery.SchemaField("createddate", "DATETIME"),
+    bigquery.SchemaField("incidentdate", "DATETIME"),
+    bigquery.SchemaField("rejecteddate", "DATETIME"),
+    bigquery.SchemaField("referreddate", "DATETIME"),
+    bigquery.SchemaField("assigneddate", "DATETIME"),
+    bigquery.SchemaField("appointmentscheduleddate", "DATETIME"),
+    bigquery.SchemaField("chasedate", "DATETIME"),
+    bigquery.SchemaField("signedupdate", "DATETIME"),
+    bigquery.SchemaField("casecloseddate", "DATETIME"),
+    bigquery.SchemaField("lostdate", "DATETIME"),
+    bigquery.SchemaField("underreviewdate", "DATETIME"),
+    bigquery.SchemaField("pendingsignupdate", "DATETIME"),
+    bigquery.SchemaField("holddate", "DATETIME"),
+    bigquery.SchemaField("intake_firstname", "STRING"),
+    bigquery.SchemaField("intake_lastname", "STRING"),
+    bigquery.SchemaField("intake_email", "STRING"),
+    bigquery.SchemaField("intake_code", "STRING"),
+    bigquery.SchemaField("paralegal_firstname", "STRING"),
+    bigquery.SchemaField("paralegal_lastname", "STRING"),
+    bigquery.SchemaField("paralegal_email", "STRING"),
+    bigquery.SchemaField("paralegal_code", "STRING"),
+    bigquery.SchemaField("investigator_firstname", "STRING"),
+    bigquery.SchemaField("investigator_lastname", "STRING"),
+    bigquery.SchemaField("investigator_email", "STRING"),
+    bigquery.SchemaField("investigator_code", "STRING"),
+    bigquery.SchemaField("attorney_firstname", "STRING"),
+    bigquery.SchemaField("attorney_lastname", "STRING"),
+    bigquery.SchemaField("attorney_email", "STRING"),
+    bigquery.SchemaField("attorney_code", "STRING"),
+    bigquery.SchemaField("creator_firstname", "STRING"),
+    bigquery.SchemaField("creator_lastname", "STRING"),
+    bigquery.SchemaField("creator_email", "STRING"),
+    bigquery.SchemaField("creator_code", "STRING"),
+    bigquery.SchemaField("phonecall_id", "INTEGER"),
+    bigquery.SchemaField("phonecall_callfrom", "STRING"),
+    bigquery.SchemaField("phonecall_callto", "STRING"),
+    bigquery.SchemaField("phonecall_callsid", "STRING"),
+    bigquery.SchemaField("phonecall_label", "STRING"),
+    bigquery.SchemaField("phonecall_recordingurl", "STRING"),
+    bigquery.SchemaField("phonecall_createddate", "DATETIME"),
+]
+
+def upload_to_bigquery(leads, table_id, write_mode, clustering_fields=None):
     """ Upload to Big Query
 
-    This function takes an array of NDJSON formatted leads and uploads the set of leads to a
-    BigQuery table.
+    This function takes a set of normalized leads and uploads them to a BigQuery table
+    as NDJSON.
 
-    :param leads: (array) array of leads in JSON format to be uploaded to BigQuery
+    :param leads: (iterable) normalized leads to be uploaded to BigQuery
     :param table_id (string) id of the table to insert records into
     :param write_mode (bigquery.WriteDisposition) WriteDisposition that tells the function
     how to handle inserting records when a table already exists
+    :param clustering_fields (list) fields to cluster the table by if the load creates the table
     :return none
     """
-    client = bigquery.Client()
+    client = get_bigquery_client()
 
     job_config = bigquery.LoadJobConfig(
-        schema=[bigquery.SchemaField("id", "INTEGER"),
-                bigquery.SchemaField("status", "STRING"),
-                bigquery.SchemaField("substatus", "STRING"),
-                bigquery.SchemaField("severitylevel", "INTEGER"),
-                bigquery.SchemaField("code", "STRING"),
-                bigquery.SchemaField("contact_firstname", "STRING"),
-                bigquery.SchemaField("contact_middlename", "STRING"),
-                bigquery.SchemaField("contact_lastname", "STRING"),
-                bigquery.SchemaField("contact_address1", "STRING"),
-                bigquery.SchemaField("contact_address2", "STRING"),
-                bigquery.SchemaField("contact_city", "STRING"),
-                bigquery.SchemaField("contact_state", "STRING"),
-                bigquery.SchemaField("contact_zip", "STRING"),
-                bigquery.SchemaField("contact_county", "STRING"),
-                bigquery.SchemaField("contact_homephone", "STRING"),
-                bigquery.SchemaField("contact_mobilephone", "STRING"),
-                bigquery.SchemaField("contact_workphone", "STRING"),
-                bigquery.SchemaField("contact_email", "STRING"),
-                bigquery.SchemaField("contact_preferredcontactmethod", "STRING"),
-                bigquery.SchemaField("contact_birthdate", "DATE"),
-                bigquery.SchemaField("contact_subscribetomailinglist", "BOOL"),
-                bigquery.SchemaField("contact_badaddress", "BOOL"),
-                bigquery.SchemaField("contact_deceased", "BOOL"),
-                bigquery.SchemaField("contact_gender", "STRING"),
-                bigquery.SchemaField("contact_minor", "BOOL"),
-                bigquery.SchemaField("contact_language", "STRING"),
-                bigquery.SchemaField("practicearea_name", "STRING"),
-                bigquery.SchemaField("practicearea_code", "STRING"),
-                bigquery.SchemaField("marketingsource", "STRING"),
-                bigquery.SchemaField("contactsource", "STRING"),
-                bigquery.SchemaField("talkedtootherattorneys", "BOOL"),
-                bigquery.SchemaField("utm", "STRING"),
-                bigquery.SchemaField("currenturl", "STRING"),
-                bigquery.SchemaField("referringurl", "STRING"),
-                bigquery.SchemaField("clickid", "STRING"),
-                bigquery.SchemaField("clientid", "STRING"),
-                bigquery.SchemaField("keywords", "STRING"),
-                bigquery.SchemaField("campaign", "STRING"),
-                bigquery.SchemaField("appointmentlocation", "STRING"),
-                bigquery.SchemaField("office", "STRING"),
-                bigquery.SchemaField("referredto_name", "STRING"),
-                bigquery.SchemaField("referredbyname", "STRING"),
-                bigquery.SchemaField("createddate", "DATETIME"),
-                bigquery.SchemaField("incidentdate", "DATETIME"),
-                bigquery.SchemaField("rejecteddate","DATETIME"),
-                bigquery.SchemaField("referreddate","DATETIME"),
-                bigquery.SchemaField("assigneddate","DATETIME"),
-                bigquery.SchemaField("appointmentscheduleddate","DATETIME"),
-                bigquery.SchemaField("chasedate","DATETIME"),
-                bigquery.SchemaField("signedupdate","DATETIME"),
-                bigquery.SchemaField("casecloseddate","DATETIME"),
-                bigquery.SchemaField("lostdate","DATETIME"),
-                bigquery.SchemaField("underreviewdate", "DATETIME"),
-                bigquery.SchemaField("pendingsignupdate", "DATETIME"),
-                bigquery.SchemaField("holddate","DATETIME"),
-                bigquery.SchemaField("intake_firstname", "STRING"),
-                bigquery.SchemaField("intake_lastname", "STRING"),
-                bigquery.SchemaField("intake_email", "STRING"),
-                bigquery.SchemaField("intake_code", "STRING"),
-                bigquery.SchemaField("paralegal_firstname", "STRING"),
-                bigquery.SchemaField("paralegal_lastname", "STRING"),
-                bigquery.SchemaField("paralegal_email", "STRING"),
-                bigquery.SchemaField("paralegal_code", "STRING"),
-                bigquery.SchemaField("investigator_firstname", "STRING"),
-                bigquery.SchemaField("investigator_lastname", "STRING"),
-                bigquery.SchemaField("investigator_email", "STRING"),
-                bigquery.SchemaField("investigator_code", "STRING"),
-                bigquery.SchemaField("attorney_firstname", "STRING"),
-                bigquery.SchemaField("attorney_lastname", "STRING"),
-                bigquery.SchemaField("attorney_email", "STRING"),
-                bigquery.SchemaField("attorney_code", "STRING"),
-                bigquery.SchemaField("creator_firstname", "STRING"),
-                bigquery.SchemaField("creator_lastname", "STRING"),
-                bigquery.SchemaField("creator_email", "STRING"),
-                bigquery.SchemaField("creator_code", "STRING"),
-                bigquery.SchemaField("phonecall_id", "INTEGER"),
-                bigquery.SchemaField("phonecall_callfrom", "STRING"),
-                bigquery.SchemaField("phonecall_callto", "STRING"),
-                bigquery.SchemaField("phonecall_callsid", "STRING"),
-                bigquery.SchemaField("phonecall_label", "STRING"),
-                bigquery.SchemaField("phonecall_recordingurl", "STRING"),
-                bigquery.SchemaField("phonecall_createddate", "DATETIME")],
+        schema=LEAD_SCHEMA,
+        clustering_fields=clustering_fields,
         write_disposition=write_mode,
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
 
     # For some reason, BigQuery doesn't like loading json with
     # load_table_from_json: https://stackoverflow.com/questions/59681072
-    leads_as_file = io.StringIO(leads)
+    leads_as_file = NDJSONReader(leads)
     load_job = client.load_table_from_file(
         leads_as_file,
         table_id,
@@ -302,6 +461,21 @@ def upload_to_bigquery(leads, table_id, write_mode):
         print(load_job.errors)
         raise e
 
+# The fields that are updated when a lead that is already in the production table changes.
+# It is assumed that information about the contact will not change (name, phone number, address, etc), but
+# the status of the lead might (dates, whether an attorney is assigned to the case, etc.)
+MERGE_UPDATE_FIELDS = (
+    "status", "substatus", "rejecteddate", "referreddate", "assigneddate", "appointmentscheduleddate",
+    "chasedate", "signedupdate", "casecloseddate", "lostdate", "underreviewdate", "pendingsignupdate",
+    "holddate", "paralegal_firstname", "paralegal_lastname", "paralegal_email", "paralegal_code",
+    "investigator_firstname", "investigator_lastname", "investigator_email", "investigator_code",
+    "attorney_firstname", "attorney_lastname", "attorney_email", "attorney_code", "phonecall_id",
+    "phonecall_callfrom", "phonecall_callto", "phonecall_callsid", "phonecall_label",
+    "phonecall_recordingurl", "phonecall_createddate",
+)
+# The UPDATE SET clause of the merge query, built once from MERGE_UPDATE_FIELDS
+MERGE_UPDATE_SET = ", ".join(f"{field} = staging.{field}" for field in MERGE_UPDATE_FIELDS)
+
 def upsert_to_bigquery(prod_table_id, staging_table_id):
     """ Upserts one table into another table
 
@@ -315,36 +489,20 @@ def upsert_to_bigquery(prod_table_id, staging_table_id):
     :return: (int) the number of rows inserted into the production table
     """
 
-    client = bigquery.Client()
+    client = get_bigquery_client()
 
     # Get the row count before the change so that the delta can be tracked
     destination_table = client.get_table(prod_table_id)
     row_count_before_query = destination_table.num_rows
 
     # Uses a merge query to simulate an upsert operation. When a field already exists, the query will update
-    # all fields that might have changed. When not matched, a row is inserted.
-    # It is assumed that information about the contact will not change (name, phone number, address, etc), but
-    # the status of the lead might (dates, whether an attorney is assigned to the case, etc.)
+    # all fields that might have changed (MERGE_UPDATE_FIELDS). When not matched, a row is inserted.
     query = f"""
         MERGE {prod_table_id} prod
         USING {staging_table_id} staging
         ON prod.Id = staging.Id
         WHEN MATCHED THEN
-          UPDATE SET status = staging.status, substatus = staging.substatus, rejecteddate = staging.rejecteddate,
-          referreddate = staging.referreddate, assigneddate = staging.assigneddate,
-          appointmentscheduleddate = staging.appointmentscheduleddate, chasedate = staging.chasedate,
-          signedupdate = staging.signedupdate, casecloseddate = staging.casecloseddate, lostdate = staging.lostdate,
-          underreviewdate = staging.underreviewdate, pendingsignupdate = staging.pendingsignupdate,
-          holddate = staging.signedupdate, paralegal_firstname = staging.paralegal_firstname, 
-          paralegal_lastname = staging.paralegal_lastname,paralegal_email = staging.paralegal_email, 
-          paralegal_code = staging.paralegal_code, investigator_firstname = staging.investigator_firstname,
-          investigator_lastname = staging.investigator_lastname, investigator_email = staging.investigator_email, 
-          investigator_code = staging.investigator_code, attorney_firstname = staging.attorney_firstname, 
-          attorney_lastname = staging.attorney_lastname,attorney_email = staging.attorney_email, 
-          attorney_code = staging.attorney_code, phonecall_id = staging.phonecall_id,
-          phonecall_callfrom = staging.phonecall_callfrom, phonecall_callto = staging.phonecall_callto,
-          phonecall_callsid = staging.phonecall_callsid, phonecall_label = staging.phonecall_label,
-          phonecall_recordingurl = staging.phonecall_recordingurl, phonecall_createddate = staging.phonecall_createddate
+          UPDATE SET {MERGE_UPDATE_SET}
         WHEN NOT MATCHED THEN
           INSERT ROW
     """
@@ -359,6 +517,92 @@ def upsert_to_bigquery(prod_table_id, staging_table_id):
     print("The merge query loaded {} rows.".format(rows_inserted))
     return rows_inserted
 
+# Maps each column of a normalized lead to the path of keys that holds its value in a detailed lead
+LEAD_FIELD_MAP = (
+    ("id", ("Id",)),
+    ("status", ("Status",)),
+    ("substatus", ("SubStatus",)),
+    ("severitylevel", ("SeverityLevel",)),
+    ("code", ("Code",)),
+    ("contact_firstname", ("Contact", "FirstName")),
+    ("contact_middlename", ("Contact", "MiddleName")),
+    ("contact_lastname", ("Contact", "LastName")),
+    ("contact_address1", ("Contact", "Address1")),
+    ("contact_address2", ("Contact", "Address2")),
+    ("contact_city", ("Contact", "City")),
+    ("contact_state", ("Contact", "State")),
+    ("contact_zip", ("Contact", "Zip")),
+    ("contact_county", ("Contact", "County")),
+    ("contact_homephone", ("Contact", "HomePhone")),
+    ("contact_mobilephone", ("Contact", "MobilePhone")),
+    ("contact_workphone", ("Contact", "WorkPhone")),
+    ("contact_email", ("Contact", "Email")),
+    ("contact_preferredcontactmethod", ("Contact", "PreferredContactMethod")),
+    ("contact_birthdate", ("Contact", "Birthdate")),
+    ("contact_subscribetomailinglist", ("Contact", "SubscribeToMailingList")),
+    ("contact_badaddress", ("Contact", "BadAddress")),
+    ("contact_deceased", ("Contact", "Deceased")),
+    ("contact_gender", ("Contact", "Gender")),
+    ("contact_minor", ("Contact", "Minor")),
+    ("contact_language", ("Contact", "Language")),
+    ("practicearea_name", ("PracticeArea", "Name")),
+    ("practicearea_code", ("PracticeArea", "Code")),
+    ("marketingsource", ("MarketingSource",)),
+    ("contactsource", ("ContactSource",)),
+    ("talkedtootherattorneys", ("TalkedToOtherAttorneys",)),
+    ("utm", ("UTM",)),
+    ("currenturl", ("CurrentUrl",)),
+    ("referringurl", ("ReferringUrl",)),
+    ("clickid", ("ClickId",)),
+    ("clientid", ("ClientId",)),
+    ("keywords", ("Keywords",)),
+    ("campaign", ("Campaign",)),
+    ("appointmentlocation", ("AppointmentLocation",)),
+    ("office", ("Office",)),
+    ("referredto_name", ("ReferredTo", "Name")),
+    ("referredbyname", ("ReferredByName",)),
+    ("createddate", ("CreatedDate",)),
+    ("incidentdate", ("IncidentDate",)),
+    ("rejecteddate", ("RejectedDate",)),
+    ("referreddate", ("ReferredDate",)),
+    ("assigneddate", ("AssignedDate",)),
+    ("appointmentscheduleddate", ("AppointmentScheduledDate",)),
+    ("chasedate", ("ChaseDate",)),
+    ("signedupdate", ("SignedUpDate",)),
+    ("casecloseddate", ("CaseClosedDate",)),
+    ("lostdate", ("LostDate",)),
+    ("underreviewdate", ("UnderReviewDate",)),
+    ("pendingsignupdate", ("PendingSignupDate",)),
+    ("holddate", ("HoldDate",)),
+    ("intake_firstname", ("Intake", "FirstName")),
+    ("intake_lastname", ("Intake", "LastName")),
+    ("intake_email", ("Intake", "Email")),
+    ("intake_code", ("Intake", "Code")),
+    ("paralegal_firstname", ("Paralegal", "FirstName")),
+    ("paralegal_lastname", ("Paralegal", "LastName")),
+    ("paralegal_email", ("Paralegal", "Email")),
+    ("paralegal_code", ("Paralegal", "Code")),
+    ("investigator_firstname", ("Investigator", "FirstName")),
+    ("investigator_lastname", ("Investigator", "LastName")),
+    ("investigator_email", ("Investigator", "Email")),
+    ("investigator_code", ("Investigator", "Code")),
+    ("attorney_firstname", ("Attorney", "FirstName")),
+    ("attorney_lastname", ("Attorney", "LastName")),
+    ("attorney_email", ("Attorney", "Email")),
+    ("attorney_code", ("Attorney", "Code")),
+    ("creator_firstname", ("Creator", "FirstName")),
+    ("creator_lastname", ("Creator", "LastName")),
+    ("creator_email", ("Creator", "Email")),
+    ("creator_code", ("Creator", "Code")),
+    ("phonecall_id", ("PhoneCall", "Id")),
+    ("phonecall_callfrom", ("PhoneCall", "CallFrom")),
+    ("phonecall_callto", ("PhoneCall", "CallTo")),
+    ("phonecall_callsid", ("PhoneCall", "CallSID")),
+    ("phonecall_label", ("PhoneCall", "Label")),
+    ("phonecall_recordingurl", ("PhoneCall", "RecordingUrl")),
+    ("phonecall_createddate", ("PhoneCall", "CreatedDate")),
+)
+
 def normalize_lead(detailed_lead):
     """ Normalizes a single detailed lead
 
@@ -378,133 +622,30 @@ def normalize_lead(detailed_lead):
     :return: (dict) a normalized LeadDocket lead loaded into a python dict
     """
 
-    def _normalize_person_field(json_data, field):
-        if not json_data[field]:
-            json_data[field] = {
-                "FirstName": None,
-                "LastName": None,
-                "Email": None,
-                "Code": None
-            }
-
-        return json_data
-
-    def _normalize_referral_field(json_data, field):
-        if not json_data[field]:
-            json_data[field] = {
-                "Name": None,
-            }
-
-        return json_data
-
-    def _normalize_phonecall_field(json_data, field):
-        if not json_data[field]:
-            json_data[field] = {
-                "Id": None,
-                "CallFrom": None,
-                "CallTo": None,
-                "CallSID": None,
-                "Label": None,
-                "RecordingUrl": None,
-                "CreatedDate": None
-            }
-        return json_data
-
     if detailed_lead['Contact']['Birthdate']:
         detailed_lead['Contact']['Birthdate'] = convert_datetime_to_date(detailed_lead['Contact']['Birthdate'])
 
     detailed_lead = convert_severity_level_to_severity_id(detailed_lead)
-    detailed_lead = _normalize_person_field(detailed_lead, "Paralegal")
-    detailed_lead = _normalize_person_field(detailed_lead, "Investigator")
-    detailed_lead = _normalize_person_field(detailed_lead, "Attorney")
-    detailed_lead = _normalize_person_field(detailed_lead, "Creator")
-    detailed_lead = _normalize_person_field(detailed_lead, "Investigator")
-    detailed_lead = _normalize_person_field(detailed_lead, "Intake")
-    detailed_lead = _normalize_referral_field(detailed_lead, "ReferredBy")
-    detailed_lead = _normalize_referral_field(detailed_lead, "ReferredTo")
-    detailed_lead = _normalize_phonecall_field(detailed_lead, "PhoneCall")
 
     new_lead = {}
-    new_lead['id'] = detailed_lead['Id']
-    new_lead['status'] = detailed_lead['Status']
-    new_lead['substatus'] = detailed_lead['SubStatus']
-    new_lead['severitylevel'] = convert_severity_level_to_severity_id(detailed_lead)['SeverityLevel']
-    new_lead['code'] = detailed_lead['Code']
-    new_lead['contact_firstname'] = detailed_lead['Contact']['FirstName']
-    new_lead['contact_middlename'] = detailed_lead['Contact']['MiddleName']
-    new_lead['contact_lastname'] = detailed_lead['Contact']['LastName']
-    new_lead['contact_address1'] = detailed_lead['Contact']['Address1']
-    new_lead['contact_address2'] = detailed_lead['Contact']['Address2']
-    new_lead['contact_city'] = detailed_lead['Contact']['City']
-    new_lead['contact_state'] = detailed_lead['Contact']['State']
-    new_lead['contact_zip'] = detailed_lead['Contact']['Zip']
-    new_lead['contact_county'] = detailed_lead['Contact']['County']
-    new_lead['contact_homephone'] = detailed_lead['Contact']['HomePhone']
-    new_lead['contact_mobilephone'] = detailed_lead['Contact']['MobilePhone']
-    new_lead['contact_workphone'] = detailed_lead['Contact']['WorkPhone']
-    new_lead['contact_email'] = detailed_lead['Contact']['Email']
-    new_lead['contact_preferredcontactmethod'] = detailed_lead['Contact']['PreferredContactMethod']
-    new_lead['contact_birthdate'] = detailed_lead['Contact']['Birthdate']
-    new_lead['contact_subscribetomailinglist'] = detailed_lead['Contact']['SubscribeToMailingList']
-    new_lead['contact_badaddress'] = detailed_lead['Contact']['BadAddress']
-    new_lead['contact_deceased'] = detailed_lead['Contact']['Deceased']
-    new_lead['contact_gender'] = detailed_lead['Contact']['Gender']
-    new_lead['contact_minor'] = detailed_lead['Contact']['Minor']
-    new_lead['contact_language'] = detailed_lead['Contact']['Language']
-    new_lead['practicearea_name'] = detailed_lead['PracticeArea']['Name']
-    new_lead['practicearea_code'] = detailed_lead['PracticeArea']['Code']
-    new_lead['marketingsource'] = detailed_lead['MarketingSource']
-    new_lead['contactsource'] = detailed_lead['ContactSource']
-    new_lead['talkedtootherattorneys'] = detailed_lead['TalkedToOtherAttorneys']
-    new_lead['utm'] = detailed_lead['UTM']
-    new_lead['currenturl'] = detailed_lead['CurrentUrl']
-    new_lead['clickid'] = detailed_lead['ClickId']
-    new_lead['clientid'] = detailed_lead['ClientId']
-    new_lead['keywords'] = detailed_lead['Keywords']
-    new_lead['campaign'] = detailed_lead['Campaign']
-    new_lead['appointmentlocation'] = detailed_lead['AppointmentLocation']
-    new_lead['office'] = detailed_lead['Office']
-    new_lead['referredto_name'] = detailed_lead['ReferredTo']['Name']
-    new_lead['referredbyname'] = detailed_lead['ReferredByName']
-    new_lead['createddate'] = detailed_lead['CreatedDate']
-    new_lead['incidentdate'] = detailed_lead['IncidentDate']
-    new_lead['rejecteddate'] = detailed_lead['RejectedDate']
-    new_lead['referreddate'] = detailed_lead['ReferredDate']
-    new_lead['assigneddate'] = detailed_lead['AssignedDate']
-    new_lead['appointmentscheduleddate'] = detailed_lead['AppointmentScheduledDate']
-    new_lead['chasedate'] = detailed_lead['ChaseDate']
-    new_lead['signedupdate'] = detailed_lead['SignedUpDate']
-    new_lead['casecloseddate'] = detailed_lead['CaseClosedDate']
-    new_lead['lostdate'] = detailed_lead['LostDate']
-    new_lead['underreviewdate'] = detailed_lead['UnderReviewDate']
-    new_lead['pendingsignupdate'] = detailed_lead['PendingSignupDate']
-    new_lead['holddate'] = detailed_lead['HoldDate']
-    new_lead['paralegal_firstname'] = detailed_lead['Paralegal']['FirstName']
-    new_lead['paralegal_lastname'] = detailed_lead['Paralegal']['LastName']
-    new_lead['paralegal_email'] = detailed_lead['Paralegal']['Email']
-    new_lead['paralegal_code'] = detailed_lead['Paralegal']['Code']
-    new_lead['investigator_firstname'] = detailed_lead['Investigator']['FirstName']
-    new_lead['investigator_lastname'] = detailed_lead['Investigator']['LastName']
-    new_lead['investigator_email'] = detailed_lead['Investigator']['Email']
-    new_lead['investigator_code'] = detailed_lead['Investigator']['Code']
-    new_lead['attorney_firstname'] = detailed_lead['Attorney']['FirstName']
-    new_lead['attorney_lastname'] = detailed_lead['Attorney']['LastName']
-    new_lead['attorney_email'] = detailed_lead['Attorney']['Email']
-    new_lead['attorney_code'] = detailed_lead['Attorney']['Code']
-    new_lead['creator_firstname'] = detailed_lead['Creator']['FirstName']
-    new_lead['creator_lastname'] = detailed_lead['Creator']['LastName']
-    new_lead['creator_email'] = detailed_lead['Creator']['Email']
-    new_lead['creator_code'] = detailed_lead['Creator']['Code']
-    new_lead['phonecall_id'] = detailed_lead['PhoneCall']['Id']
-    new_lead['phonecall_callfrom'] = detailed_lead['PhoneCall']['CallFrom']
-    new_lead['phonecall_callto'] = detailed_lead['PhoneCall']['CallTo']
-    new_lead['phonecall_callsid'] = detailed_lead['PhoneCall']['CallSID']
-    new_lead['phonecall_label'] = detailed_lead['PhoneCall']['Label']
-    new_lead['phonecall_recordingurl'] = detailed_lead['PhoneCall']['RecordingUrl']
-    new_lead['phonecall_createddate'] = detailed_lead['PhoneCall']['CreatedDate']
+    for field, path in LEAD_FIELD_MAP:
+        # Empty nested objects (an unassigned attorney, no phone call, etc.) become null values
+        value = detailed_lead
+        for key in path:
+            value = value.get(key) if value else None
+        new_lead[field] = value
 
     return new_lead
 
+# Maps the severity text returned by the API to the severity id used in UI reports
+SEVERITY_IDS = {
+    "No Case": 1,
+    "Unlikely Case - No Injuries": 2,
+    "Possible Case - Minor Injuries / Light Therapy / Short Hospital Stay": 3,
+    "Likely Case - Moderate Injuries / Ongoing Treatment": 4,
+    "Very Likely Case - Severe Injuries / Catastrophic": 5,
+}
+
 def convert_severity_level_to_severity_id(detailed_lead):
     """ Convert Severity To Severity Level
 
@@ -515,58 +656,48 @@ def convert_severity_level_to_severity_id(detailed_lead):
     :param detailed_lead: (dict) a single lead represented as a dictionary (with a SeverityLevel)
     :return detailedLead (dict) a single lead represented as a dictionary (with a SeverityId)
     """
-    if detailed_lead['SeverityLevel'] == "No Case":
-        detailed_lead['SeverityLevel'] = 1
-    if detailed_lead['SeverityLevel'] == "Unlikely Case - No Injuries":
-        detailed_lead['SeverityLevel'] = 2
-    if detailed_lead['SeverityLevel'] == "Possible Case - Minor Injuries / Light Therapy / Short Hospital Stay":
-        detailed_lead['SeverityLevel'] = 3
-    if detailed_lead['SeverityLevel'] == "Likely Case - Moderate Injuries / Ongoing Treatment":
-        detailed_lead['SeverityLevel'] = 4
-    if detailed_lead['SeverityLevel'] == "Very Likely Case - Severe Injuries / Catastrophic":
-        detailed_lead['SeverityLevel'] = 5
+    detailed_lead['SeverityLevel'] = SEVERITY_IDS.get(detailed_lead['SeverityLevel'], detailed_lead['SeverityLevel'])
 
     return detailed_lead
 
 
-def get_lead_details(leads_to_update, headers):
+def get_lead_details(leads_to_update, headers, executor):
     """ Gets the details for every lead in a set of leads
 
     A function that gets all of the details for each lead in a list of LeadDocket leads. This function
-    iterates through a list of leads and gathers detailed information on all of them, then returns a list
-    of detailed leads with all of the information needed to store in BigQuery.
+    submits a request for the details of each lead to the executor, and returns the futures for the
+    detailed leads with all of the information needed to store in BigQuery.
+
+    The requests are sent as soon as this function is called, so the caller can do other work
+    (such as checking that the BigQuery tables exist) while the leads are fetched. The caller owns
+    the executor, and should cancel the futures if it stops before reading all of the results.
 
     :param leads_to_update: (list) A list of LeadDocket lead summaries in JSON format
     :param headers: (str) the headers to use for API requests to LeadDocket
-    :return: (list) List of detailed leads
+    :param executor: (ThreadPoolExecutor) the thread pool to send the requests from
+    :return: (list) futures for the detailed leads, in the same order as leads_to_update
     """
 
-    global TOTALREQUESTS
-    detailed_leads = []
-    current_lead_counter = 1
-    for lead in leads_to_update:
-        print(f"Processing lead {current_lead_counter} of {LEADCOUNT}")
-        lead_by_id_endpoint = f"leads/{lead['Id']}"
-        url = urljoin(LEAD_DOCKET_BASE_URL, lead_by_id_endpoint)
+    def _fetch_and_normalize(lead_number, lead):
+        print(f"Processing lead {lead_number} of {LEADCOUNT}")
+        url = f"{LEADS_BY_ID_URL}{lead['Id']}"
 
         # Pass the response to an error handler to deal with rate limits and unexpected errors.
         # The error handler will retry a single failed request
-        response = handle_api_errors(requests.get(url, headers=headers), url, headers)
-        TOTALREQUESTS +=1
+        response = handle_api_errors(get_from_lead_docket(url, headers), url, headers)
 
         if (response.status_code != 200):
-            print(f"API requests have continued to fail on lead {current_lead_counter} of {LEADCOUNT}")
+            print(f"API requests have continued to fail on lead {lead_number} of {LEADCOUNT}")
             exit("API requests failing after waiting. Exiting Early")
 
-        detailed_lead = response.json()
-
         # Normalize the lead to ensure data consistency
-        detailed_leads.append(normalize_lead(detailed_lead))
+        return normalize_lead(orjson.loads(response.content))
 
-        current_lead_counter += 1
-
-    return detailed_leads
+    # The detail requests are bound by network latency, so they are sent from a pool of threads
+    return [executor.submit(_fetch_and_normalize, lead_number, lead)
+            for lead_number, lead in enumerate(leads_to_update, start=1)]
 
+@functools.lru_cache(maxsize=1)
 def get_secret(project_id, secret_id):
     """ Get a secret from Google Secret Manager
 
@@ -579,7 +710,7 @@ def get_secret(project_id, secret_id):
     """
 
     name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-    client = secretmanager.SecretManagerServiceClient()
+    client = get_secret_manager_client()
 
     try:
         response = client.access_secret_version(request={"name": name})
@@ -589,20 +720,21 @@ def get_secret(project_id, secret_id):
     payload = response.payload.data.decode("UTF-8")
     return payload
 
+@functools.lru_cache(maxsize=1)
 def get_lead_docket_headers():
     """ Get Lead Docket Headers
 
     This is a simple function to get the static headers for API requests to LeadDocket. This
-    function exists to lessen the number of calls to the fetch the API key.
+    function exists to lessen the number of calls to the fetch the API key, and the headers are
+    cached for the lifetime of the process (including warm Cloud Function invocations).
 
     :return: headers (dict) a dictionary of headers to use for Lead Docket API requests
     """
     project_id = os.environ.get('PROJECT_ID')
     secret_id = os.environ.get('SECRET_ID')
 
-    if not (project_id, secret_id):
-        exit("Required environment variables not set. Please ensure PROJECT_ID and SECRET_ID have been configured"
-             "have been configured")
+    if not (project_id and secret_id):
+        exit("Required environment variables not set. Please ensure PROJECT_ID and SECRET_ID have been configured")
 
     headers = {
         'Accept': 'application/json',
@@ -642,11 +774,11 @@ def google_cloud_main(event, context):
     prod_table_id = os.environ.get('PROD_TABLE_ID')
     staging_table_id = os.environ.get('STAGING_TABLE_ID')
 
-    if not (dataset_id, prod_table_id, staging_table_id):
-        exit("Required environment variables not set. Please ensure DATASET_ID, PROD_TABLE_ID, and STAGING_TABLE_ID"
+    if not (dataset_id and prod_table_id and staging_table_id):
+        exit("Required environment variables not set. Please ensure DATASET_ID, PROD_TABLE_ID, and STAGING_TABLE_ID "
              "have been configured")
 
-    client = bigquery.Client()
+    client = get_bigquery_client()
 
     def _dataset_exists(client, dataset_id):
         try:
@@ -668,14 +800,17 @@ def google_cloud_main(event, context):
 
     try:
         # try to convert event data to a JSON object
-        event_data = json.loads(base64.b64decode(event['data']).decode('utf-8'))
-    except json.JSONDecodeError as e:
+        event_data = orjson.loads(base64.b64decode(event['data']))
+    except orjson.JSONDecodeError as e:
         print(f"Error reading event param: {e}")
 
     if(isinstance(event_data, int)):
-        # By default, Python reads input as a string. Convert the string to an integer.
-        pub_sub_time = int(base64.b64decode(event['data']).decode('utf-8'))
-        leads_to_update = [{ "Id": lead["Id"] } for lead in get_lead_changes_since(pub_sub_time, headers)]
+        # The message is a single integer, which has already been decoded above
+        pub_sub_time = event_data
+        # A lead can show up more than once when its status changes while the pages are being read.
+        # Only request the details for each lead once, and avoid duplicate ids in the staging table
+        lead_ids = dict.fromkeys(lead["Id"] for lead in get_lead_changes_since(pub_sub_time, headers))
+        leads_to_update = [{ "Id": lead_id } for lead_id in lead_ids]
         batches = [leads_to_update[i:i+BATCH_SIZE] for i in range(0, len(leads_to_update), BATCH_SIZE)]
         print(f"{len(batches)} batches to process with batch size {BATCH_SIZE}.")
 
@@ -687,40 +822,60 @@ def google_cloud_main(event, context):
         for batch in batches:
             print(f"publishing batch {i}")
             i += 1
-            publisher.publish(topic_path, json.dumps({'leads':batch, 'batch_num': i}).encode('utf-8'))
+            publisher.publish(topic_path, orjson.dumps({'leads':batch, 'batch_num': i}))
     else:
         leads_to_update = event_data.get("leads")
-        global LEADCOUNT
+        global LEADCOUNT, DATASET_EXISTS, PROD_TABLE_EXISTS
         LEADCOUNT = len(leads_to_update)
         print(f"Batch #{event_data.get('batch_num')}: Updating {LEADCOUNT} leads... ")
 
-        detailed_leads = get_lead_details(leads_to_update, headers)
-        if not (_dataset_exists(client, dataset_id)):
-            print(f"The {dataset_id} dataset does not exist. Creating dataset...")
-            dataset = bigquery.Dataset(dataset_id)
-            dataset.location = "US"
-            client.create_dataset(dataset, timeout=30)
-            print(f"The {dataset_id} dataset has been created")
-
-
-        if not (_table_exists(client, prod_table_id)):
-            # If the prod table doesn't exist, write directly to the prod table
-            try:
-                # Parallel function execution could a create race condition where multiple
-                # cloud functions enter this if branch and one creates the table before the
-                # other, causing an error on the second creation attempt
-                upload_to_bigquery(convert_to_newline_delimeted_json(detailed_leads), prod_table_id, write_mode=bigquery.WriteDisposition.WRITE_EMPTY)
-            except Conflict as e:
-                print(f"Table already exists: {e}")
-                # TODO Messy duplicate code (with else branch below), consider refactoring
+        # Start fetching the leads before checking the dataset and tables, so that the checks
+        # and the start of the upload happen while the requests are in flight
+        executor = ThreadPoolExecutor(max_workers=LEADDOCKET_CONCURRENCY)
+        lead_futures = get_lead_details(leads_to_update, headers, executor)
+        try:
+            detailed_leads = (future.result() for future in lead_futures)
+
+            if not (DATASET_EXISTS or _dataset_exists(client, dataset_id)):
+                print(f"The {dataset_id} dataset does not exist. Creating dataset...")
+                dataset = bigquery.Dataset(dataset_id)
+                dataset.location = "US"
+                client.create_dataset(dataset, timeout=30)
+                print(f"The {dataset_id} dataset has been created")
+            DATASET_EXISTS = True
+
+            if not (PROD_TABLE_EXISTS or _table_exists(client, prod_table_id)):
+                # The leads may need to be uploaded a second time if the prod table is created by
+                # another function first, so gather all of them before uploading
+                detailed_leads = list(detailed_leads)
+
+                # If the prod table doesn't exist, write directly to the prod table
+                try:
+                    # Parallel function execution could a create race condition where multiple
+                    # cloud functions enter this if branch and one creates the table before the
+                    # other, causing an error on the second creation attempt
+                    # The prod table is clustered by id so that the merge query only reads the blocks
+                    # that hold the leads being updated
+                    upload_to_bigquery(detailed_leads, prod_table_id, write_mode=bigquery.WriteDisposition.WRITE_EMPTY,
+                                       clustering_fields=["id"])
+                except Conflict as e:
+                    print(f"Table already exists: {e}")
+                    # TODO Messy duplicate code (with else branch below), consider refactoring
+                    # If the prod table already exists, overwrite the staging page
+                    upload_to_bigquery(detailed_leads, staging_table_id, write_mode=bigquery.WriteDisposition.WRITE_TRUNCATE)
+                    # Merge the staging table into the production table
+                    upsert_to_bigquery(prod_table_id, staging_table_id)
+            else:
                 # If the prod table already exists, overwrite the staging page
-                upload_to_bigquery(convert_to_newline_delimeted_json(detailed_leads), staging_table_id, write_mode=bigquery.WriteDisposition.WRITE_TRUNCATE)
+                upload_to_bigquery(detailed_leads, staging_table_id, write_mode=bigquery.WriteDisposition.WRITE_TRUNCATE)
                 # Merge the staging table into the production table
                 upsert_to_bigquery(prod_table_id, staging_table_id)
-        else:
-            # If the prod table already exists, overwrite the staging page
-            upload_to_bigquery(convert_to_newline_delimeted_json(detailed_leads), staging_table_id, write_mode=bigquery.WriteDisposition.WRITE_TRUNCATE)
-            # Merge the staging table into the production table
-            upsert_to_bigquery(prod_table_id, staging_table_id)
+            PROD_TABLE_EXISTS = True
+        finally:
+            # Cancel the requests that haven't started if the batch failed, so that they don't
+            # keep using rate limit credits after the invocation has ended
+            for future in lead_futures:
+                future.cancel()
+            executor.shutdown()
 
         print(f"Batch #{event_data.get('batch_num')} complete!")
\ No newline at end of file